@@ -1,27 +1,81 @@
 #!/usr/bin/python
 
-from __future__ import print_function
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
 import httplib2
+import json
 import os
+import random
 import signal
+import sqlite3
 import sys
+import time
+
+import google_auth_httplib2
 
 from apiclient import discovery
-from oauth2client import client
-from oauth2client import tools
-from oauth2client.file import Storage
+from apiclient import errors
+from apiclient import model
+from apiclient.http import set_user_agent
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
 
-SCOPES = 'https://www.googleapis.com/auth/drive'
+SCOPES = ['https://www.googleapis.com/auth/drive']
 CLIENT_SECRET_FILE = 'client_secret.json'
 APPLICATION_NAME = 'gdrive-archive'
 USER_AGENT = 'Google Drive Archive'
+BATCH_SIZE = 50
+MAX_TRIES = 7
+DISCOVERY_URL = ('https://www.googleapis.com/discovery/v1/apis/'
+                 'drive/v3/rest')
+DISCOVERY_TTL = 7 * 24 * 60 * 60
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+QPS_LIMIT = 10
+QUERY = "trashed=false and 'me' in owners"
+LIST_FIELDS = 'nextPageToken,files(id,name,parents)'
+
+_http = None
+_credentials = None
+RETRY_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded',
+                 'backendError')
+
+APP_DIR = os.path.join(os.path.expanduser('~'), '.credentials',
+                       APPLICATION_NAME)
+TOKEN_PATH = os.path.join(APP_DIR, 'user_token.json')
+DISCOVERY_PATH = os.path.join(APP_DIR, 'drive_v3.json')
+STATE_PATH = os.path.join(APP_DIR, 'state.db')
+os.makedirs(APP_DIR, exist_ok=True)
 
 try:
-    import argparse
-    parser = argparse.ArgumentParser(parents=[tools.argparser])
-    args = parser.parse_args()
+    import aiohttp
 except ImportError:
-    args = None
+    aiohttp = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    def _deserialize(self, content):
+        body = orjson.loads(content)
+        if self._data_wrapper and isinstance(body, dict) \
+           and 'data' in body:
+            body = body['data']
+        return body
+
+    model.JsonModel.deserialize = _deserialize
+
+parser = argparse.ArgumentParser(
+    description='Archive orphan files in Google Drive')
+parser.add_argument('--yes', action='store_true',
+                    help='archive without asking for confirmation')
+parser.add_argument('--dry-run', action='store_true',
+                    help='list orphan files without archiving them')
+args = parser.parse_args()
 
 
 def signal_handler(signal, frame):
@@ -30,67 +84,373 @@ def signal_handler(signal, frame):
 
 
 def get_credentials():
-    credential_dir = os.path.join(os.path.expanduser('~'), '.credentials')
-    if not os.path.exists(credential_dir):
-        os.makedirs(credential_dir)
-    app_dir = os.path.join(credential_dir, APPLICATION_NAME)
-    if not os.path.exists(app_dir):
-        os.makedirs(app_dir)
-    token_path = os.path.join(app_dir, 'user_token.json')
-    store = Storage(token_path)
-    credentials = store.get()
-    if not credentials or credentials.invalid:
-        secret_path = os.path.join(app_dir, 'client_secret.json')
-        flow = client.flow_from_clientsecrets(secret_path, SCOPES)
-        flow.user_agent = USER_AGENT
-        if args:
-            credentials = tools.run_flow(flow, store, args)
-        else:
-            credentials = tools.run(flow, store)
+    global _credentials
+    credentials = _credentials
+    if credentials is None and os.path.exists(TOKEN_PATH):
+        credentials = Credentials.from_authorized_user_file(TOKEN_PATH,
+                                                            SCOPES)
+    if credentials and credentials.valid \
+       and not _near_expiry(credentials):
+        _credentials = credentials
+        return credentials
+    if credentials and credentials.refresh_token:
+        credentials.refresh(Request())
+    else:
+        secret_path = os.path.join(APP_DIR, CLIENT_SECRET_FILE)
+        flow = InstalledAppFlow.from_client_secrets_file(secret_path,
+                                                         SCOPES)
+        credentials = flow.run_local_server(port=0)
+    with open(TOKEN_PATH, 'w') as token:
+        token.write(credentials.to_json())
+    _credentials = credentials
     return credentials
 
 
-def get_files(service):
-    files = []
-    next_page = None
+def _near_expiry(credentials):
+    expiry = credentials.expiry
+    return (not expiry
+            or expiry - datetime.datetime.utcnow() < REFRESH_MARGIN)
+
+
+def get_http(credentials):
+    global _http
+    if _http is None:
+        _http = set_user_agent(
+            google_auth_httplib2.AuthorizedHttp(credentials,
+                                                http=httplib2.Http()),
+            USER_AGENT)
+    return _http
+
+
+def get_service(http):
+    if os.path.exists(DISCOVERY_PATH) \
+       and time.time() - os.path.getmtime(DISCOVERY_PATH) < DISCOVERY_TTL:
+        with open(DISCOVERY_PATH) as doc:
+            return discovery.build_from_document(doc.read(), http=http)
+    response, content = http.request(DISCOVERY_URL)
+    if response.status == 200:
+        with open(DISCOVERY_PATH, 'wb') as doc:
+            doc.write(content)
+        return discovery.build_from_document(content.decode('utf-8'),
+                                             http=http)
+    return discovery.build('drive', 'v3', http=http,
+                           cache_discovery=False)
+
+
+def open_state():
+    state = sqlite3.connect(STATE_PATH)
+    state.execute('CREATE TABLE IF NOT EXISTS orphans '
+                  '(id TEXT PRIMARY KEY, name TEXT, '
+                  'archived INTEGER DEFAULT 0)')
+    state.execute('CREATE TABLE IF NOT EXISTS cursor '
+                  '(key TEXT PRIMARY KEY, value TEXT)')
+    state.commit()
+    return state
+
+
+def mark_archived(state, ids):
+    state.executemany('UPDATE orphans SET archived = 1 WHERE id = ?',
+                      [(file_id,) for file_id in ids])
+    state.commit()
+
+
+def _cursor_get(state, key):
+    row = state.execute('SELECT value FROM cursor WHERE key = ?',
+                        (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _cursor_set(state, key, value):
+    state.execute('INSERT OR REPLACE INTO cursor VALUES (?, ?)',
+                  (key, value))
+
+
+def _list_files(service, state, resume):
+    list_req = service.files().list
+
+    def fetch(page_token):
+        return list_req(q=QUERY,
+                        corpora='user',
+                        spaces='drive',
+                        pageSize=1000,
+                        fields=LIST_FIELDS,
+                        pageToken=page_token).execute()
+
     while True:
-        results = service.files().list(q='trashed=false',
-                                       spaces='drive',
-                                       pageSize=1000,
-                                       fields="nextPageToken, \
-                                       files(id, name, parents)",
-                                       pageToken=next_page).execute()
-        items = results.get('files', [])
-        if not items:
-            break
-        else:
-            for file in files:
-                if not file['parents'] and len(file['owners']) == 1 \
-                   and file['owners'][0]['isAuthenticatedUser']:
-                    files.extend(file)
-            next_page = results.get('nextPageToken')
-        if not next_page:
-            break
-    return files
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1) as pool:
+                future = pool.submit(fetch, resume)
+                while future is not None:
+                    results = future.result()
+                    next_page = results.get('nextPageToken')
+                    future = (pool.submit(fetch, next_page)
+                              if next_page else None)
+                    state.executemany(
+                        'INSERT OR IGNORE INTO orphans (id, name) '
+                        'VALUES (?, ?)',
+                        [(file['id'], file['name'])
+                         for file in results.get('files', [])
+                         if not file.get('parents')])
+                    if next_page:
+                        _cursor_set(state, 'next_page', next_page)
+                    else:
+                        state.execute("DELETE FROM cursor "
+                                      "WHERE key = 'next_page'")
+                    state.commit()
+            return
+        except errors.HttpError as exception:
+            # Saved page tokens expire; restart the walk from scratch
+            # rather than crashing on the stale cursor every run.
+            if not resume or exception.resp.status != 400:
+                raise
+            state.execute("DELETE FROM cursor WHERE key = 'next_page'")
+            state.commit()
+            resume = None
 
 
-def archive_files(service, files):
-    for file in files:
-        print(file['name'])
-        service.files().update(fileId=file['id'],
-                               body={'trashed': True}).execute()
+def _sync_changes(service, state, token):
+    while token:
+        results = service.changes().list(
+            pageToken=token,
+            spaces='drive',
+            pageSize=1000,
+            fields='newStartPageToken,nextPageToken,'
+                   'changes(fileId,removed,'
+                   'file(id,name,parents,trashed,ownedByMe))').execute()
+        for change in results.get('changes', []):
+            file = change.get('file')
+            if file and not file.get('trashed') \
+               and file.get('ownedByMe') and not file.get('parents'):
+                state.execute('INSERT OR IGNORE INTO orphans (id, name) '
+                              'VALUES (?, ?)', (file['id'], file['name']))
+            else:
+                state.execute('DELETE FROM orphans WHERE id = ?',
+                              (change['fileId'],))
+        new_start = results.get('newStartPageToken')
+        if new_start:
+            _cursor_set(state, 'changes_token', new_start)
+        state.commit()
+        token = results.get('nextPageToken')
+
+
+def get_files(service, state):
+    resume = _cursor_get(state, 'next_page')
+    changes_token = _cursor_get(state, 'changes_token')
+    if changes_token and not resume:
+        try:
+            _sync_changes(service, state, changes_token)
+        except errors.HttpError as exception:
+            # The saved changes token can expire like a page token;
+            # fall back to a fresh full listing instead of wedging
+            # every later run on the same error.
+            if exception.resp.status not in (400, 404, 410):
+                raise
+            state.execute("DELETE FROM cursor "
+                          "WHERE key = 'changes_token'")
+            state.commit()
+            changes_token = None
+    if not changes_token or resume:
+        pending = _cursor_get(state, 'pending_changes_token')
+        if not pending:
+            start = service.changes().getStartPageToken().execute()
+            pending = start.get('startPageToken')
+            _cursor_set(state, 'pending_changes_token', pending)
+            state.commit()
+        _list_files(service, state, resume)
+        _cursor_set(state, 'changes_token', pending)
+        state.execute("DELETE FROM cursor "
+                      "WHERE key = 'pending_changes_token'")
+        state.commit()
+    return [{'id': file_id, 'name': name} for file_id, name in
+            state.execute('SELECT id, name FROM orphans '
+                          'WHERE archived = 0')]
+
+
+def _retryable(exception):
+    if not isinstance(exception, errors.HttpError):
+        return False
+    if exception.resp.status in (429, 500, 503):
+        return True
+    if exception.resp.status == 403:
+        try:
+            data = json.loads(exception.content.decode('utf-8'))
+            reason = data['error']['errors'][0]['reason']
+        except (ValueError, KeyError, IndexError):
+            return False
+        return reason in RETRY_REASONS
+    return False
+
+
+def _sleep_backoff(tries, response=None):
+    delay = min(64, 2 ** tries) + random.random()
+    if response is not None and response.get('retry-after'):
+        try:
+            delay = int(response['retry-after'])
+        except ValueError:
+            pass
+    time.sleep(delay)
+
+
+def _with_backoff(request, max_tries=MAX_TRIES):
+    for tries in range(max_tries):
+        try:
+            return request.execute()
+        except errors.HttpError as exception:
+            if tries == max_tries - 1 or not _retryable(exception):
+                raise
+            _sleep_backoff(tries, exception.resp)
+
+
+class TokenBucket:
+    def __init__(self, rate=QPS_LIMIT, burst=QPS_LIMIT):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens
+                                  + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until,
+                                time.monotonic() + seconds)
+
+
+async def _error_reason(response):
+    try:
+        data = await response.json()
+        return data['error']['errors'][0]['reason']
+    except (aiohttp.ContentTypeError, ValueError, TypeError,
+            KeyError, IndexError):
+        return None
+
+
+async def archive_files_async(session, files, token):
+    sem = asyncio.Semaphore(8)
+    bucket = TokenBucket()
+    headers = {'Authorization': 'Bearer {0}'.format(token),
+               'User-Agent': USER_AGENT}
+
+    async def trash(file):
+        async with sem:
+            url = 'https://www.googleapis.com/drive/v3/files/' + file['id']
+            for tries in range(MAX_TRIES):
+                await bucket.acquire()
+                async with session.patch(url, json={'trashed': True},
+                                         headers=headers) as response:
+                    if response.status < 400:
+                        return
+                    if response.status == 403:
+                        reason = await _error_reason(response)
+                        retryable = reason in RETRY_REASONS
+                        rate_limited = (retryable
+                                        and reason != 'backendError')
+                    else:
+                        retryable = response.status in (429, 500, 503)
+                        rate_limited = response.status == 429
+                    if not retryable or tries == MAX_TRIES - 1:
+                        response.raise_for_status()
+                    retry_after = response.headers.get('Retry-After')
+                    try:
+                        delay = int(retry_after)
+                    except (TypeError, ValueError):
+                        delay = min(64, 2 ** tries) + random.random()
+                    if rate_limited or retry_after:
+                        bucket.pause(delay)
+                    else:
+                        await asyncio.sleep(delay)
+
+    results = await asyncio.gather(*[trash(file) for file in files],
+                                   return_exceptions=True)
+    sys.stdout.write('\n'.join(file['name'] for file in files) + '\n')
+    return [file for file, result in zip(files, results)
+            if isinstance(result, Exception)]
+
+
+def archive_files_concurrent(files, token, state):
+    async def run():
+        connector = aiohttp.TCPConnector(limit=10, keepalive_timeout=75)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            return await archive_files_async(session, files, token)
+
+    failed = asyncio.run(run())
+    failed_ids = {file['id'] for file in failed}
+    mark_archived(state, (file['id'] for file in files
+                          if file['id'] not in failed_ids))
+    if failed:
+        print('Failed to archive {0} file(s)'.format(len(failed)))
+
+
+def archive_files(service, files, state):
+    pending = files
+    for tries in range(MAX_TRIES):
+        done = []
+        failed = []
+        retryable = []
+
+        def record(request_id, response, exception):
+            if exception is None:
+                done.append(request_id)
+            elif _retryable(exception):
+                retryable.append(request_id)
+            else:
+                failed.append(request_id)
+
+        if tries == 0:
+            sys.stdout.write('\n'.join(file['name']
+                                       for file in pending) + '\n')
+        for start in range(0, len(pending), BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=record)
+            for file in pending[start:start + BATCH_SIZE]:
+                batch.add(service.files().update(fileId=file['id'],
+                                                 body={'trashed': True}),
+                          request_id=file['id'])
+            _with_backoff(batch)
+        mark_archived(state, done)
+        if failed:
+            print('Failed to archive {0} file(s)'.format(len(failed)))
+        if not retryable:
+            return
+        retry = set(retryable)
+        pending = [file for file in pending if file['id'] in retry]
+        _sleep_backoff(tries)
+    print('Gave up on {0} file(s)'.format(len(pending)))
 
 
 def main():
     signal.signal(signal.SIGINT, signal_handler)
     credentials = get_credentials()
-    http = credentials.authorize(httplib2.Http())
-    service = discovery.build('drive', 'v3', http=http)
-    files = get_files(service)
+    http = get_http(credentials)
+    service = get_service(http)
+    state = open_state()
+    files = get_files(service, state)
     print('Found {0} orphan file(s)'.format(len(files)))
     if files:
-        input('Press Enter to continue...')
-        archive_files(service, files)
+        if args.dry_run:
+            for file in files:
+                print(file['name'])
+            return
+        if not args.yes:
+            input('Press Enter to continue...')
+        if aiohttp:
+            archive_files_concurrent(files, credentials.token, state)
+        else:
+            archive_files(service, files, state)
 
 
 if __name__ == '__main__':